@@ -26,15 +26,22 @@ APL
 ####################################################################################################
 # IMPORTS
 ####################################################################################################
-from Bio import Entrez
+from collections import Counter
 from datetime import datetime, timedelta
+from lxml import etree
 from pptx import Presentation
 from pptx.util import Inches, Pt
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import os
+import functools
+import io
+import re
+import requests
+import shelve
 import time
-#import requests
 from pptx.dml.color import RGBColor
-from urllib.error import HTTPError
+from requests.exceptions import HTTPError
 
 
 
@@ -43,6 +50,18 @@ from urllib.error import HTTPError
 ####################################################################################################
 version = "3.0.0"
 update_date_numbers = 20240710 # last update
+template_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "template.pptx") # intro and query information slides
+eutils_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+cache_file = os.path.join(os.path.expanduser("~"), ".pubmed_cache") # shelf of efetch results keyed by PMID
+cache_max_age_days = 7
+last_request_time = 0.0 # time.monotonic() of the last E-utilities request, for rate limiting
+html_tag_pattern = re.compile(r"</?(?:sub|sup|i)>") # <sub>, <sup>, <i> tags left in titles and abstracts
+
+# slide font sizes, table colors and table geometry, built once instead of on every run or cell
+pt10, pt12, pt14, pt20 = Pt(10), Pt(12), Pt(14), Pt(20)
+black, light_grey, dark_grey = RGBColor(0, 0, 0), RGBColor(211, 211, 211), RGBColor(169, 169, 169)
+table_left, table_top, table_width, table_height = Inches(1), Inches(1.5), Inches(8), Inches(4)
+table_column_width = Inches(4)
 
 
 
@@ -55,125 +74,375 @@ update_date_numbers = 20240710 # last update
 ##############################
 # function to check user-input date formatting:
 def remove_duplicates(components):
-    seen = set()
-    return [x for x in components if not (x["Title"] in seen or seen.add(x["Title"]))]
+    # keep the first component for each title, dicts preserve insertion order
+    unique = {}
+    for component in components:
+        unique.setdefault(component["Title"], component)
+    return list(unique.values())
 
 def validate_date(date):
+    # return the parsed date, so callers don't need to parse it a second time
     try:
-        datetime.strptime(date, "%Y/%m/%d")
+        return datetime.strptime(date, "%Y/%m/%d")
     except ValueError:
         raise ValueError("Incorrect date format, should be YYYY/MM/DD")
 
-def get_pmids(combined_query: str):
+def get_session(email: str, api_key: str = None, retries: int = 5) -> requests.Session:
+    """
+    Create the HTTP session used for every E-utilities request
+        - connections are kept alive and reused, so there is no new TCP/TLS handshake per request
+        - urllib3 retries 429 and 5xx responses with exponential backoff, honoring NCBI's Retry-After header
+        - the email (and API key, if any) is sent with every request, as NCBI asks
+    """
+    retry = Retry(total=retries, 
+                  backoff_factor=0.5, 
+                  status_forcelist=[429, 500, 502, 503, 504], 
+                  allowed_methods=["GET", "POST"],  # E-utilities queries are safe to repeat
+                  raise_on_status=False)  # hand the last response to raise_for_status once retries run out
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.params = {"tool": "Journal_Lookup_Tool", "email": email}
+    if api_key:
+        # an API key raises the NCBI rate limit from 3 to 10 requests/s
+        session.params["api_key"] = api_key
+    return session
+
+def post_eutils(session: requests.Session, utility: str, **data):
+    """
+    POST a query to an E-utility (esearch.fcgi, efetch.fcgi, ...) and return the response body as a stream for lxml
+    Requests are spaced to NCBI's rate limit, 3 requests/s or 10/s with an API key, instead of a fixed 1 second sleep
+    """
+    global last_request_time
+    # 0.37s rather than 1/3s, exactly 3 requests/s still sometimes gets a 429 from NCBI
+    interval = 0.1 if "api_key" in session.params else 0.37
+    wait = last_request_time + interval - time.monotonic()
+    if wait > 0:
+        time.sleep(wait)
+    last_request_time = time.monotonic()
+
+    response = session.post(eutils_url + utility, data=data, stream=True)
+    response.raise_for_status()
+    response.raw.decode_content = True  # undo any gzip content encoding while lxml reads
+    return response.raw
+
+def get_pmids(combined_query: str, session: requests.Session) -> tuple:
     """
-    Take in a sql query and search pubmed using Entrez.esearch
+    Take in a sql query and search pubmed using esearch
+    The search results are also kept on the NCBI history server (usehistory=y), so efetch can fetch them by WebEnv
+
+    return a tuple of (pmids, webenv, query_key)
     """
     try:
-        handle = Entrez.esearch(db="pubmed", 
-                                term=combined_query, 
-                                retmax=100000)
-        try:    
-            record = Entrez.read(handle, validate=False)
-        except:
-            raise ValueError(f"Entrez.read error. Error reading XML for query {combined_query}")
-        #print(record)
-        pmids = record["IdList"]
-        return pmids
+        handle = post_eutils(session, 
+                             "esearch.fcgi", 
+                             db="pubmed", 
+                             term=combined_query, 
+                             retmax=100000, 
+                             usehistory="y")
+        try:
+            # stream the <Id> elements with libxml2 instead of building the whole record in python
+            pmids = []
+            webenv = query_key = None
+            for _, element in etree.iterparse(handle, tag=("Id", "WebEnv", "QueryKey")):
+                if element.tag == "Id":
+                    pmids.append(element.text)
+                elif element.tag == "WebEnv":
+                    webenv = element.text
+                else:
+                    query_key = element.text
+                element.clear()
+        except etree.XMLSyntaxError:
+            raise ValueError(f"lxml parse error. Error reading XML for query {combined_query}")
+        return pmids, webenv, query_key
 
     except HTTPError as e:
-        raise HTTPError(f"Entrez.esearch error. Error retrieving XML for query {combined_query}: {e}")
+        raise HTTPError(f"esearch error. Error retrieving XML for query {combined_query}: {e}")
 
-def get_paper(pmid: str):
+def expire_cache(cache, max_age_days: int = cache_max_age_days):
     """
-    Use entrez.efetch to get paper metadata
-    
+    Drop cached papers fetched more than max_age_days ago, so corrections made on pubmed are picked up
     """
-    
-    try:
-        handle = Entrez.efetch(db="pubmed", 
-                               id=pmid, 
-                               rettype="medline", 
-                               retmode="xml")
-        paper = Entrez.read(handle, validate=False)
-        #print(f"Paper with PMID {pmid} found and added")
-        #print("\n")
-    except HTTPError as e:
-        if (e.response.status_code == 500):  # If the error is an HTTP 500 error, retry
-            print("HTTP Error 500 encountered. Retrying...")
-            time.sleep(10)  # Wait for 10 second before retrying
-        elif (e.response.status_code == 429):  # If the error is an HTTP 429 error, retry after 10 seconds
-            print("HTTP Error 429 encountered. Too many requests. Retrying after 10 seconds...")
-            time.sleep(10)  # Wait for 10 seconds before retrying
+    cutoff = datetime.now() - timedelta(days=max_age_days)
+    expired = [pmid for pmid, (fetched_at, _) in cache.items() if fetched_at < cutoff]
+    for pmid in expired:
+        del cache[pmid]
+
+def strip_html_tags(text: str) -> str:
+    """
+    Remove <sub>, <sup> and <i> tags from a title or abstract in a single regex pass
+    """
+    return html_tag_pattern.sub("", text)
+
+def element_text(element) -> str:
+    """
+    Return the full text of an XML element, including text nested in inline markup like <i> or <sub>
+    """
+    return "".join(element.itertext())
+
+def get_paper_info(article) -> dict:
+    """
+    Extract fields in the paper relevant for journal club presentation from a <PubmedArticle> element
+    Fields missing from the record are left out of the component, the slides show them as not available
+
+    return the component, or None if the paper has no title
+    """
+    # look up the <Article> element once and search relative to it
+    citation = article.find("MedlineCitation/Article")
+    if citation is None:
+        return None
+
+    # Extract the title, a paper without one gets no slide
+    title = citation.find("ArticleTitle")
+    if title is None:
+        return None
+    component = {"Title": element_text(title)}
+
+    # Extract the abstract
+    abstract = citation.find("Abstract/AbstractText")
+    if abstract is not None:
+        component["Abstract"] = element_text(abstract)
+
+    # Extract the journal name
+    journal = citation.findtext("Journal/Title")
+    if journal is not None:
+        component["Journal"] = journal
+
+    # Extract the publication date
+    dates = citation.findall("ArticleDate")
+    if dates:
+        component["Date"] = [{part.tag: part.text for part in date} for date in dates]
+
+    # Extract the link to the publication
+    links = citation.findall("ELocationID")
+    if links:
+        component["Link"] = [link.text for link in links]
+
+    author_list = citation.find("AuthorList")
+    if author_list is not None:
+        # Extract the authors, group authors have no last name
+        last_names = [author.findtext("LastName") for author in author_list.iterfind("Author")]
+        last_names = [last_name for last_name in last_names if last_name is not None]
+        if last_names:
+            component["Authors"] = last_names
+
+        # Extract the affiliations
+        component["Institution"] = [
+            element_text(affiliation)
+            for affiliation in author_list.iterfind("Author/AffiliationInfo/Affiliation")
+        ]
+    return component
+
+def iter_pubmed_records(handle):
+    """
+    Stream the <PubmedArticle> records of an efetch response and extract the fields relevant for journal club
+    Only one record is held in memory at a time, it is cleared once its fields are read
+
+    yield (pmid, component) per paper
+    """
+    for _, article in etree.iterparse(handle, tag="PubmedArticle"):
+        component = get_paper_info(article)
+        if component is not None:
+            yield article.findtext("MedlineCitation/PMID"), component
+
+        # free the record, and drop the root's references to the records already read
+        article.clear()
+        while article.getprevious() is not None:
+            del article.getparent()[0]
+
+def fetch_papers(session: requests.Session, cache, **query) -> list:
+    """
+    Run one efetch query, stream its records, and cache each paper's fields by PMID
+
+    return a list of components, one per paper
+    """
+    handle = post_eutils(session, 
+                         "efetch.fcgi", 
+                         db="pubmed", 
+                         rettype="medline", 
+                         retmode="xml", 
+                         **query)
+    components = []
+    fetched_at = datetime.now()
+    for pmid, component in iter_pubmed_records(handle):
+        cache[pmid] = (fetched_at, component)
+        components.append(component)
+    return components
+
+def get_papers(pmids: list, 
+               session: requests.Session, 
+               cache = None, 
+               webenv: str = None, 
+               query_key: str = None, 
+               batch_size: int = 200, 
+               history_batch_size: int = 10000) -> list:
+    """
+    Use efetch to get the fields relevant for journal club presentation, for each paper
+    PMIDs found in the cache, a shelf of {pmid: (fetch time, component)}, are not fetched again
+    If none are cached and the search is on the history server (webenv, query_key), the server fetches the
+    whole result set, up to history_batch_size papers per request
+    Otherwise the missing PMIDs are sent comma-separated, batch_size per request
+
+    return a list of components, one per paper
+    """
+    if cache is None:
+        cache = {}
+
+    # Papers fetched on an earlier query or run
+    components = []
+    missing = []
+    for pmid in pmids:
+        entry = cache.get(pmid)
+        if entry is not None:
+            components.append(entry[1])
         else:
-            raise e# If the error is not an HTTP 500 or 429 error, raise it
-    return paper
-
-def get_paper_info(papers: list) -> list:
-    """
-    Extract fields in the paper relevant for journal club presentation
-    """
-    # Update the components list based on the updated papers list
-    components = []  
-    for paper in papers:
-        for article in paper["PubmedArticle"]:
-            if "MedlineCitation" in article and "Article" in article["MedlineCitation"]:
-                component = {}
-                # Extract the title                
-                try:
-                    component["Title"] = article["MedlineCitation"]["Article"]["ArticleTitle"]
-                except KeyError:
-                    component["Title"] = "No title available"
-                    #break out of for loop if no title available
-                    break
-                
-                # Extract the abstract
-                try:
-                    component["Abstract"] = article["MedlineCitation"]["Article"]["Abstract"]["AbstractText"][0]
-                except KeyError:
-                    component["Abstract"] = "No abstract available"
-                    break
-
-                # Extract the journal name
-                if (
-                    "Journal" in article["MedlineCitation"]["Article"]
-                    and "Title" in article["MedlineCitation"]["Article"]["Journal"]
-                ):
-                    component["Journal"] = article["MedlineCitation"]["Article"]["Journal"]["Title"]
-
-                # Extract the publication date
-                try:
-                    component["Date"] = article["MedlineCitation"]["Article"]["ArticleDate"]
-                except KeyError:
-                    component["Date"] = "No date available"
-                
-                # Extract the link to the publication
-                try:
-                    component["Link"] = article["MedlineCitation"]["Article"]["ELocationID"]
-                except KeyError:
-                    component["Link"] = "No link available"
-
-                # Extract the authors
-                try:
-                    component["Authors"] = [
-                        f"{author['LastName']}"
-                        for author in article["MedlineCitation"]["Article"]["AuthorList"]
-                    ]
-                except KeyError:
-                    component["Authors"] = "No authors available"
-                
-                # Extract the affiliations
-                if "AuthorList" in article["MedlineCitation"]["Article"]:
-                    component["Institution"] = [
-                        str(affiliation["Affiliation"])
-                        for author in article["MedlineCitation"]["Article"]["AuthorList"]
-                        if "AffiliationInfo" in author
-                        for affiliation in author["AffiliationInfo"]
-                    ]
-                components.append(component)
-
-    components = remove_duplicates(components)
+            missing.append(pmid)
+
+    # Everything else comes from pubmed, and is cached by PMID
+    if webenv is not None and len(missing) == len(pmids):
+        for retstart in range(0, len(pmids), history_batch_size):
+            components.extend(fetch_papers(session, 
+                                           cache, 
+                                           WebEnv=webenv, 
+                                           query_key=query_key, 
+                                           retstart=retstart, 
+                                           retmax=history_batch_size))
+    else:
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            components.extend(fetch_papers(session, cache, id=",".join(batch)))
     return components
 
+@functools.lru_cache
+def line_pattern(max_characters_per_line: int) -> re.Pattern:
+    """
+    Regex matching one wrapped line: up to max_characters_per_line characters, starting and ending on
+    non-whitespace and followed by whitespace or the end of the text
+    Words longer than a line are split every max_characters_per_line characters
+    """
+    return re.compile(rf"\S(?:.{{0,{max_characters_per_line - 2}}}\S)?(?=\s|$)|\S{{{max_characters_per_line}}}")
+
+def add_wrapped_text(paragraph, text: str, max_characters_per_line: int, font_size):
+    """
+    Add text to a pptx paragraph as one run per line, wrapped at the last space before max_characters_per_line
+    All line breaks are found in one findall scan by the C regex engine
+    """
+    lines = line_pattern(max_characters_per_line).findall(text)
+    for i, line in enumerate(lines):
+        run = paragraph.add_run()
+        # newline at the end of each line but the last
+        run.text = line + "\n" if i < len(lines) - 1 else line
+        run.font.size = font_size
+
+def add_paper_slides(presentation, components: list):
+    """
+    Add a slide per paper to the presentation:
+        - title, abstract, journal and publication date, DOI, authors and top two institutions
+    """
+    # layout and text box geometry are the same for every paper slide, so look them up once
+    slide_layout = presentation.slide_layouts[6]
+    add_slide = presentation.slides.add_slide
+    left = top = Inches(0)  # Sets the left and top position of the text box to 1 inch from the slide's left edge            
+    width = height =  presentation.slide_width - Inches(0.5)  # Adjust the width to fit the slide and set equal to height
+    for component in components:
+        # Add a slide with a blank layout
+        slide = add_slide(slide_layout)
+        tf = slide.shapes.add_textbox(left, top, width, height).text_frame
+        add_paragraph = tf.add_paragraph
+        # Add the article's title text
+        p = add_paragraph()
+        run = p.add_run() 
+        max_characters_per_line = 75 # adjusted to 75 from 80
+        title_plain_text = strip_html_tags(component["Title"])
+        add_wrapped_text(p, title_plain_text, max_characters_per_line, pt20)
+        # Add a blank line
+        add_paragraph()
+        # Add the abstract text
+        max_characters_per_line = 115
+        p = add_paragraph()
+        run = p.add_run()
+        if "Abstract" in component:
+            abstract_plain_text = strip_html_tags(component["Abstract"])
+            add_wrapped_text(p, abstract_plain_text, max_characters_per_line, pt14)
+        else:
+            run.text = "Abstract: Not available"
+            run.font.size = pt14
+        # Add a blank line
+        add_paragraph()
+        # Add the journal name and publication date
+        # collect the lines first, run.text re-writes the run's XML on every assignment
+        journal_date_lines = []
+        # Check if 'journal' is in the component
+        if "Journal" in component:
+            journal_date_lines.append("Published in: " + component["Journal"] + "\n")
+        else:
+            journal_date_lines.append("Journal: Not available\n")
+
+        # Check if 'date' is in the component
+        if "Date" in component:
+            # print ("Date found!")
+            date = component["Date"][0]  # Get the first date
+            # Check if 'Year', 'Month', and 'Day' are in the date
+            if "Year" in date and "Month" in date and "Day" in date:
+                date_str = "{}/{}/{}".format(
+                    date["Year"], date["Month"], date["Day"]
+                )  # Format the date as a string
+                journal_date_lines.append("Publication Date: " + date_str + "\n")
+        else:
+            journal_date_lines.append("Publication Date: not available\n")
+        p = add_paragraph()
+        run = p.add_run()
+        run.text = "".join(journal_date_lines)
+        run.font.size = pt12
+        # Add the DOI
+        p = add_paragraph()
+        run = p.add_run()
+        if "Link" in component:
+            run.text = "DOI: " + component["Link"][0] + "\n"
+        else:
+            run.text = "DOI: not available\n"
+        run.font.size = pt10  # Set the font size
+        # Add the Authors
+        max_characters_per_line = 170
+        p = add_paragraph()
+        run = p.add_run()
+        if "Authors" in component:
+            authors_plain_text = "Authors: " + ", ".join(component["Authors"])
+            add_wrapped_text(p, authors_plain_text, max_characters_per_line, pt10)
+        else:
+            run.text = "Authors: Not available"
+            run.font.size = pt10  # Set the font size
+        # Add a blank line
+        add_paragraph()
+        # Add the Institutions
+        p = add_paragraph()
+        run = p.add_run()
+        max_characters_per_line = 170
+        # Count the frequency of each institution and select the top two
+        top_two_institutions = Counter(component.get("Institution", [])).most_common(2)
+        # Create a list of strings containing the institution names and their counts, making combined string
+        institution_info = [f"{institution} {count}" for institution, count in top_two_institutions]
+        # Joining the list of strings into a single string
+        institution_text = "Institutions: " + "; ".join(institution_info)
+        add_wrapped_text(p, institution_text, max_characters_per_line, pt10)
+
+def fill_template(presentation, fields: dict):
+    """
+    Replace the {name} placeholders in the text runs of the template slides with fields[name]
+    """
+    for slide in presentation.slides:
+        for shape in slide.shapes:
+            if not shape.has_text_frame:
+                continue
+            for paragraph in shape.text_frame.paragraphs:
+                for run in paragraph.runs:
+                    text = run.text
+                    if "{" not in text:
+                        continue
+                    for name, value in fields.items():
+                        text = text.replace("{" + name + "}", value)
+                    run.text = text
+
 def get_pptx(start_end_date: tuple,
              config_file_dict: dict, 
              components: list, 
@@ -182,7 +451,7 @@ def get_pptx(start_end_date: tuple,
              update_date_numbers: int = update_date_numbers, ):
     """
     Producing the powerpoint file:
-        - Creates an intro / about slide
+        - Fills in the intro / about and query information slides of template.pptx
         - Creates a summary of articles found slide
         - Creates a slide-per-abstract and relevant information, ready for import into google sheets website!
             - this can be copy/pasted slide-wise into the journal club Google Slides Presentation
@@ -192,152 +461,55 @@ def get_pptx(start_end_date: tuple,
         print(f"{pptx_name} already exists. Please rename or delete it.")
         return
         
-    # Create a new presentation in powerpoint
-    presentation = Presentation()
+    # Open the template, it already holds the intro and query information slides
+    presentation = Presentation(template_file)
 
     # Retrieve the start and end dates
     start_date, end_date = start_end_date
+    if end_date == "3000/01/01":
+        end_date = datetime.now().strftime("%Y/%m/%d")
 
     # Retrieve the journals of interest
     email = config_file_dict['email']
     journals_of_interest = config_file_dict['journals']
     topics = config_file_dict['topics']
 
-    # slide for the introduction
-    slide_layout = presentation.slide_layouts[5]
-    slide = presentation.slides.add_slide(slide_layout)
-    title = slide.shapes.title
-    title.text = f"Journal Lookup Tool v{version}"
-    left = Inches(1)
-    top = Inches(1.5)
-    width = Inches(8)
-    height = Inches(4)
-    txBox = slide.shapes.add_textbox(left, top, width, height)
-    tf = txBox.text_frame
-    p = tf.add_paragraph()
-    p.text = f"By AP Ledray, updated {update_date_numbers}"
-    p.space_after = Pt(14)
-    p = tf.add_paragraph()
-    p.text = "contact: aaronledray@gmail.com"
-    p = tf.add_paragraph()
-    p.text = ""
-
-    # slide for the username, dates, and journals
-    slide_layout = presentation.slide_layouts[5]
-    slide = presentation.slides.add_slide(slide_layout)
-    title = slide.shapes.title
-    title.text = "Query Information (1):"
-    left = Inches(1)
-    top = Inches(1.5)
-    width = Inches(8)
-    height = Inches(4)
-    txBox = slide.shapes.add_textbox(left, top, width, height)
-    tf = txBox.text_frame
-    p = tf.add_paragraph()
-    run = p.add_run()
-    run.text = f"Username: {email}"
-    run.font.size = Pt(16)
-    p = tf.add_paragraph()
-    p.text = ""
-    p = tf.add_paragraph()
-    run = p.add_run()
-    run.text = f"Query start date: {start_date}\n"
-    if end_date == "3000/01/01":
-        current_date = datetime.now()
-        current_formatted_date = current_date.strftime("%Y/%m/%d")
-        run.text += f"Query end date: {current_formatted_date}\n"
-    else:
-        run.text += f"Query end date: {end_date}\n"
-    run.font.size = Pt(12)
-    p = tf.add_paragraph()
-    p.text = ""
-    p = tf.add_paragraph()
-    run = p.add_run()
-    run.text = "Query journals:"
-    run.font.size = Pt(16)
-    for journal in journals_of_interest:
-        p = tf.add_paragraph()
-        run = p.add_run()
-        run.text = journal
-        run.font.size = Pt(12)
-
-    # slide for the keywords
-    max_characters_per_line = 100
-    slide_layout = presentation.slide_layouts[5]
-    slide = presentation.slides.add_slide(slide_layout)
-    title = slide.shapes.title
-    title.text = "Query Information (2):"
-    left = Inches(1)
-    top = Inches(1.5)
-    width = Inches(8)
-    height = Inches(4)
-    txBox = slide.shapes.add_textbox(left, top, width, height)
-    tf = txBox.text_frame
-    p = tf.add_paragraph()
-    run = p.add_run()
-    run.text = "Query keywords:"
-    p = tf.add_paragraph()
-    run.font.size = Pt(16)
     # Need to first turn all keywrods of interest into a single string separated by commas.
-    combined_keyword_queries = ", ".join(topics)
-    if len(combined_keyword_queries) > max_characters_per_line:
-        while len(combined_keyword_queries) > max_characters_per_line:
-            # Find the last space before the Xth character
-            split_index = combined_keyword_queries.rfind(" ", 0, max_characters_per_line)
-            if split_index == -1:
-                split_index = max_characters_per_line
-            chunk = combined_keyword_queries[:split_index]
-            combined_keyword_queries = combined_keyword_queries[
-                split_index:
-            ].lstrip()  # Remove leading spaces from the remaining text
-            run = p.add_run()
-            run.text = chunk + "\n"
-            # print (chunk)
-            run.font.size = Pt(12)
-        # Add the remaining text
-        run = p.add_run()
-        run.text = combined_keyword_queries
-        # print (title_plain_text)
-        run.font.size = Pt(12)
-    else:
-        p = tf.add_paragraph()
-        run = p.add_run()
-        run.text = combined_keyword_queries
-        run.font.size = Pt(12)
-
-    # Initialize a dictionary to store the article counts for each journal
+    max_characters_per_line = 100
+    combined_keyword_queries = "\n".join(line_pattern(max_characters_per_line).findall(", ".join(topics)))
+
+    # Fill in the query information
+    fill_template(presentation, {
+        "version": version,
+        "update_date": str(update_date_numbers),
+        "email": email,
+        "start_date": str(start_date),
+        "end_date": str(end_date),
+        "journals": "\n".join(journals_of_interest),
+        "keywords": combined_keyword_queries,
+    })
+
+    # Count the articles for each journal
     # Journal_data is a weird name for it, but it's the frequency of each journal hit
-    journal_data = {}
-    for component in components:
-        if "Journal" in component:
-            journal_name = component["Journal"]
-            journal_data[journal_name] = journal_data.get(journal_name, 0) + 1
+    journal_data = Counter(component["Journal"] for component in components if "Journal" in component)
 
     #slide for the journal summary table
     slide_layout = presentation.slide_layouts[5]
     slide = presentation.slides.add_slide(slide_layout)
     title = slide.shapes.title
     title.text = "Journals Found:"
-    left = Inches(1)
-    top = Inches(1.5)
-    width = Inches(8)
-    height = Inches(4)
     table = slide.shapes.add_table(
         rows=len(journal_data) + 1,
         cols=2,
-        left=left,
-        top=top,
-        width=width,
-        height=height,
+        left=table_left,
+        top=table_top,
+        width=table_width,
+        height=table_height,
     ).table
-    table.columns[0].width = Inches(4)
-    table.columns[1].width = Inches(4)
+    table.columns[0].width = table_column_width
+    table.columns[1].width = table_column_width
     table.cell(0, 0).text = "Journal"
     table.cell(0, 1).text = "Number of Articles"
-    black = RGBColor(0, 0, 0)
-    # Defining colors for the table:
-    light_grey = RGBColor(211, 211, 211)
-    dark_grey = RGBColor(169, 169, 169)
     # Set the color of the header row to black
     for cell in table.rows[0].cells:
         fill = cell.fill
@@ -363,203 +535,17 @@ def get_pptx(start_end_date: tuple,
             fill_1.fore_color.rgb = dark_grey 
         
     # Paper-wise, so it's for all i in components:
-    for component in components:
-        # Add a slide with a blank layout
-        slide_layout = presentation.slide_layouts[6]
-        slide = presentation.slides.add_slide(slide_layout)
-        left = top = Inches(0)  # Sets the left and top position of the text box to 1 inch from the slide's left edge            
-        width = height =  presentation.slide_width - Inches(0.5)  # Adjust the width to fit the slide and set equal to height
-        txBox = slide.shapes.add_textbox(left, top, width, height)
-        tf = txBox.text_frame
-        # Add the article's title text
-        p = tf.add_paragraph()
-        run = p.add_run() 
-        max_characters_per_line = 75 # adjusted to 75 from 80
-        # TODO: split this replace chain into a function so you can call it in both spots
-        title_plain_text = (
-            component["Title"]
-            .replace("<sub>", "")
-            .replace("</sub>", "")
-            .replace("<i>", "")
-            .replace("</i>", "")
-            .replace("<sup>", "")
-            .replace("</sup>", "")
-        )
-        if len(title_plain_text) > max_characters_per_line:
-            while len(title_plain_text) > max_characters_per_line:
-                # Find the last space before the Xth character
-                split_index = title_plain_text.rfind(" ", 0, max_characters_per_line)
-                if split_index == -1:
-                    split_index = max_characters_per_line
-                chunk = title_plain_text[:split_index]
-                title_plain_text = title_plain_text[
-                    split_index:
-                ].lstrip()  # Remove leading spaces from the remaining text
-                run = p.add_run()
-                run.text = chunk + "\n"
-                # print (chunk)
-                run.font.size = Pt(20)
-            # Add the remaining text
-            run = p.add_run()
-            run.text = title_plain_text
-            # print (title_plain_text)
-            run.font.size = Pt(20)
-        else:
-            p = tf.add_paragraph()
-            run = p.add_run()
-            run.text = title_plain_text
-            run.font.size = Pt(20)
-        # Add a blank line
-        tf.add_paragraph()
-        # Add the abstract text
-        max_characters_per_line = 115
-        p = tf.add_paragraph()
-        run = p.add_run()
-        if "Abstract" in component:
-            abstract_plain_text = (
-                component["Abstract"]
-                .replace("<sub>", "")
-                .replace("</sub>", "")
-                .replace("<i>", "")
-                .replace("</i>", "")
-                .replace("<sup>", "")
-                .replace("</sup>", "")
-            )
-            if len(abstract_plain_text) > max_characters_per_line:
-                while len(abstract_plain_text) > max_characters_per_line:
-                    # Find the last space before the Xth character
-                    split_index = abstract_plain_text.rfind(
-                        " ", 0, max_characters_per_line
-                    )
-                    if split_index == -1:
-                        # If no space was found, split at the Xth character
-                        split_index = max_characters_per_line
-                    chunk = abstract_plain_text[:split_index]
-                    abstract_plain_text = abstract_plain_text[
-                        split_index:
-                    ].lstrip()  # Remove leading spaces from the remaining text
-                    run = p.add_run()
-                    run.text = chunk + "\n"  # Add a newline at the end of each chunk
-                    run.font.size = Pt(14)
-                # Add the remaining text
-                run = p.add_run()
-                run.text = abstract_plain_text
-                run.font.size = Pt(14)
-            else:
-                run = p.add_run()
-                run.text = abstract_plain_text
-                run.font.size = Pt(14)
-        else:
-            run.text = "Abstract: Not available"
-            run.font.size = Pt(14)
-        # Add a blank line
-        tf.add_paragraph()
-        # Add the journal name and publication date
-        p = tf.add_paragraph()
-        run = p.add_run()
-        # Check if 'journal' is in the component
-        if "Journal" in component:
-            run.text += "Published in: " + component["Journal"] + "\n"
-            run.font.size = Pt(12)
-        else:
-            run.text += "Journal: Not available\n"
-            run.font.size = Pt(12)
-
-        # Check if 'date' is in the component
-        if "Date" in component:
-            # print ("Date found!")
-            date = component["Date"][0]  # Get the first date
-            # Check if 'Year', 'Month', and 'Day' are in the date
-            if "Year" in date and "Month" in date and "Day" in date:
-                date_str = "{}/{}/{}".format(
-                    date["Year"], date["Month"], date["Day"]
-                )  # Format the date as a string
-                run.text += "Publication Date: " + date_str + "\n"
-        else:
-            run.text += "Publication Date: not available\n"
-        # Add the DOI
-        p = tf.add_paragraph()
-        run = p.add_run()
-        run.text = "DOI: " + component["Link"][0] + "\n"
-        run.font.size = Pt(10)  # Set the font size
-        # Add the Authors
-        max_characters_per_line = 170
-        p = tf.add_paragraph()
-        run = p.add_run()
-        if "Authors" in component:
-            authors_plain_text = "Authors: " + ", ".join(component["Authors"])
-            if len(authors_plain_text) > max_characters_per_line:
-                while len(authors_plain_text) > max_characters_per_line:
-                    # Find the last space before the Xth character
-                    split_index = authors_plain_text.rfind(
-                        " ", 0, max_characters_per_line
-                    )
-                    if split_index == -1:
-                        # If no space was found, split at the Xth character
-                        split_index = max_characters_per_line
-                    chunk = authors_plain_text[:split_index]
-                    authors_plain_text = authors_plain_text[
-                        split_index:
-                    ].lstrip()  # Remove leading spaces from the remaining text
-                    run = p.add_run()
-                    run.text = chunk + "\n"
-                    run.font.size = Pt(10)  # Set the font size
-                # Add the remaining text
-                run = p.add_run()
-                run.text = authors_plain_text
-                run.font.size = Pt(10)  # Set the font size
-            else:
-                # p = tf.add_paragraph()
-                run = p.add_run()
-                run.text = authors_plain_text
-                run.font.size = Pt(10)  # Set the font size
-        else:
-            run.text = "Authors: Not available"
-            run.font.size = Pt(10)  # Set the font size
-        # Add a blank line
-        tf.add_paragraph()
-        # Add the Institutions
-        p = tf.add_paragraph()
-        run = p.add_run()
-        max_characters_per_line = 170
-        if "Institution" in component:
-            # Count the frequency of each institution
-            institution_count = {}
-            for institution in component["Institution"]:
-                if institution in institution_count:
-                    institution_count[institution] += 1
-                else:
-                    institution_count[institution] = 1
-
-
-        # Sort the institutions by frequency and select the top two    
-        top_two_institutions = sorted(institution_count, key=institution_count.get, reverse=True)[:2]
-        # Create a list of strings containing the institution names and their counts, making combined string
-        institution_info = [f"{institution} {institution_count[institution]}" for institution in top_two_institutions]
-        # Joining the list of strings into a single string
-        institution_text = "Institutions: " + "; ".join(institution_info)
-        # Check if the text is too long to print directly and needs to be formatted:
-        if len(institution_text) > max_characters_per_line:
-            # Split the text into chunks and add newlines
-            while len(institution_text) > max_characters_per_line:
-                split_index = institution_text.rfind(" ", 0, max_characters_per_line)
-                if split_index == -1:
-                    split_index = max_characters_per_line
-                chunk = institution_text[:split_index]
-                institution_text = institution_text[split_index:].lstrip()
-                run = p.add_run()
-                run.text = chunk + "\n"
-                run.font.size = Pt(10)
-            # Add the remaining text
-            run = p.add_run()
-            run.text = institution_text
-            run.font.size = Pt(10)
-        else:
-            run.text = institution_text
-            run.font.size = Pt(10)
+    add_paper_slides(presentation, components)
 
     # Finally, save the presentation!
-    presentation.save("publications.pptx")
+    # serialize in memory, then write it out in one go and move it into place, so a failed save never
+    # leaves a half-written file behind
+    buffer = io.BytesIO()
+    presentation.save(buffer)
+    temporary_name = pptx_name + ".tmp"
+    with open(temporary_name, "wb") as f:
+        f.write(buffer.getvalue())
+    os.replace(temporary_name, pptx_name)
 
 
 #############################
@@ -572,11 +558,13 @@ def read_config_file(config_file : str = 'config.txt') -> dict:
     first paragraph is user email
     second paragraph is journal name, one per line
     third paragraph is topic, one per line
+    optional fourth paragraph is an NCBI API key
 
     Read config file and return dictionary of
     {'email': user_email, 
     'journals': [journal1, journal2, ...],
-    'topics': [topic1, topic2, ...]}
+    'topics': [topic1, topic2, ...],
+    'api_key': api_key or None}
 
     """
     if os.path.exists(config_file):
@@ -588,12 +576,15 @@ def read_config_file(config_file : str = 'config.txt') -> dict:
             #check for empty file
             if len(lines) == 0:
                 raise ValueError("config.txt is empty")
-            #check for exactly 3 paragraph
+            #check for exactly 3 paragraph, plus the optional API key paragraph
+            paragraphs = lines.split('\n\n')
+            if len(paragraphs) == 3:
+                paragraphs.append('')
             try:
-                email, journals, topic = lines.split('\n\n')
+                email, journals, topic, api_key = paragraphs
             except:
                 raise ValueError('config.txt improperly formatted. ' + 
-                      'Please make sure there are three paragraphs separated by two newlines')
+                      'Please make sure there are three paragraphs (four with an API key) separated by two newlines')
             
             #make sure only one email is provided
             if email.count('@') != 1:
@@ -610,6 +601,7 @@ def read_config_file(config_file : str = 'config.txt') -> dict:
         config_file_dict['email'] = email.strip()
         config_file_dict['journals'] = journals.splitlines()
         config_file_dict['topics'] = topic.splitlines()
+        config_file_dict['api_key'] = api_key.strip() or None
 
         return config_file_dict
 
@@ -635,34 +627,30 @@ def ask_user_date(end_date_default: str = '3000/01/01') -> tuple:
         start_date = input(
             "Please enter the start date (YYYY/MM/DD), for example 2020/01/01: "
         )
-        validate_date(start_date)
+        start_date = validate_date(start_date)
         end_date = input("Please enter the end date (YYYY/MM/DD), for example 3000/01/01: ")
         if end_date == "":
             end_date = end_date_default
-        else:
-            validate_date(end_date)
+        end_date = validate_date(end_date)
 
-        start_date = datetime.strptime(start_date, "%Y/%m/%d")
-        end_date = datetime.strptime(end_date, "%Y/%m/%d")
-        
 
     print(f"Start date: {start_date}")
     print(f"End date: {end_date}")    
 
     return (start_date, end_date)
 
-def lookup_pubmed(config_file_dict : dict, start_end_date: tuple, attempt_number: int = 2) -> list:
+def lookup_pubmed(config_file_dict : dict, start_end_date: tuple) -> list:
     """
     Use the config file dictionary to search pubmed for articles
-    Pubmed is queried with keyword combos
+    Pubmed is queried once per journal, with all keywords combined by OR
 
-    Sql query of Pubmed via Entrez.esearch using string of the format:
-    '{keyword_query} AND ("{start_date}"[Date - Entry] : "{end_date}"[Date - Entry]) AND "{journal_of_interest}"[Journal]'
+    Sql query of Pubmed via esearch using string of the format:
+    '({keyword_1}) OR ({keyword_2}) ... AND ("{start_date}"[Date - Entry] : "{end_date}"[Date - Entry]) AND "{journal_of_interest}"[Journal]'
 
-    return a list of papers
+    return a list of components, one per paper, with duplicate titles removed
     """
-    # Initialize the lists for papers and components
-    papers = []
+    # Initialize the list for components
+    components = []
 
     #retrieve values from config file
     email = config_file_dict['email']
@@ -672,35 +660,42 @@ def lookup_pubmed(config_file_dict : dict, start_end_date: tuple, attempt_number
     #retrieve values from start_end_date tuple
     start_date, end_date = start_end_date
 
-    # Set the email for Entrez
-    Entrez.email = email
-
-    # Fetch PMIDs based on the keyword query
-    for journal_of_interest in journals:
-        print(f'Searching journal: {journal_of_interest}')
-        for keyword_query in keywords:
-            # Construct the combined query for pubmed:
-            combined_query = f'{keyword_query} AND ("{start_date}"[Date - Entry] : "{end_date}"[Date - Entry]) AND "{journal_of_interest}"[Journal]'
+    # Construct the combined queries for pubmed up front, one per journal:
+    # each keyword keeps its own parentheses, so multi-word keywords are still matched as before
+    keyword_query = "(" + " OR ".join(f"({keyword})" for keyword in keywords) + ")"
+    date_query = f'("{start_date}"[Date - Entry] : "{end_date}"[Date - Entry])'
+    combined_queries = [
+        (journal_of_interest, f'{keyword_query} AND {date_query} AND "{journal_of_interest}"[Journal]')
+        for journal_of_interest in journals
+    ]
+
+    # One keep-alive session, with the email and API key, for all E-utilities requests
+    session = get_session(email, config_file_dict['api_key'])
+
+    # Papers fetched on earlier runs are kept on disk, keyed by PMID
+    with shelve.open(cache_file) as cache:
+        expire_cache(cache)
+
+        # Fetch PMIDs based on the keyword query
+        for journal_of_interest, combined_query in combined_queries:
+            print(f'Searching journal: {journal_of_interest}')
             #print(f"Pubmed query keywords: {combined_query}")
             
             # Fetch the PMIDs for the query
-            pmids = get_pmids(combined_query)
+            pmids, webenv, query_key = get_pmids(combined_query, session)
             #print(f"PMIDs found: {pmids}")
             
             # for successful PMIDs found from the queries:
-            # Fetch the metadata of the papers for each PMID
-            for pmid in pmids:
-                # THIS IS IMPORTANT, or requests will be denied:
-                time.sleep(1)  # Add a delay of 1 second between each request    
-                for _ in range(attempt_number):  # Try (x) times!
-                    try:
-                        paper = get_paper(pmid)
-                        papers.append(paper)
-                    except HTTPError as e:
-                        print(f"HTTPError encountered: {e}")
-                        print(f"Failed to retrieve paper with PMID {pmid}")
-                        continue
-    return papers
+            # Fetch the metadata of all papers for the query in batched requests, or from the history server
+            if len(pmids) == 0:
+                continue
+            # retries with backoff happen in the session, so an error here means they were used up
+            try:
+                components.extend(get_papers(pmids, session, cache, webenv, query_key))
+            except HTTPError as e:
+                print(f"HTTPError encountered: {e}")
+                print(f"Failed to retrieve papers for query {combined_query}")
+    return remove_duplicates(components)
 
 
 
@@ -792,13 +787,11 @@ def main():
     
     #2. Get date range
     start_end_date = ask_user_date()
-    print('Looking up papers...   ')
-    papers = lookup_pubmed(config_file_dict=config_file_dict, 
-                start_end_date=start_end_date)
     
     #3. Get paper info
-    print('Getting paper info...   ')
-    components = get_paper_info(papers)
+    print('Looking up papers...   ')
+    components = lookup_pubmed(config_file_dict=config_file_dict, 
+                start_end_date=start_end_date)
     #print(components)
 
     if len(components) == 0: